@@ -1,11 +1,42 @@
 import bibtexparser
+from bibtexparser.bibdatabase import BibDatabase
+from bibtexparser.bwriter import BibTexWriter
+import hashlib
 import json
+import random
+import re
+import sqlite3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import quote
 import logging
 import argparse
 from tqdm import tqdm
+import threading
 import time  # Added for rate limiting
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import orjson  # optional: much faster parsing of DBLP search responses
+except ImportError:
+    orjson = None
+
+
+def positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+
+def positive_float(value):
+    number = float(value)
+    if not number > 0:  # also rejects nan
+        raise argparse.ArgumentTypeError(f"must be a positive number, got {value}")
+    return number
+
 
 # --- ARGUMENT PARSING ---
 # (Existing parser code remains the same)
@@ -13,128 +44,463 @@ parser = argparse.ArgumentParser(description="Update BibTeX entries using DBLP."
 parser.add_argument("--bib_file", default="old.bib", help="Path to the input BibTeX file")
 parser.add_argument("--output_file", default="output.bib", help="Path to save the updated BibTeX file")
 parser.add_argument("--log_file", default="log.txt", help="Path for the log file")
+parser.add_argument("--cache_file", default="dblp_cache.sqlite", help="Path to the persistent DBLP lookup cache")
+parser.add_argument("--workers", type=positive_int, default=5, help="Maximum number of concurrent DBLP queries")
+parser.add_argument("--max_rate", type=positive_float, default=1.0,
+                    help="Maximum DBLP requests per second, shared by all workers")
+parser.add_argument("--skip_complete", action="store_true",
+                    help="Keep entries that already have a DOI, year, author and title without querying DBLP")
+parser.add_argument("--merge_near_duplicates", action="store_true",
+                    help="Let near-duplicate titles (e.g. punctuation or spelling variants) share one DBLP lookup")
+parser.add_argument("--verbose", action="store_true", help="Log the field-level differences of changed entries")
 args = parser.parse_args()
 
 BIB_FILE = args.bib_file
 OUTPUT_BIB_FILE = args.output_file
 LOG_FILE = args.log_file
+CACHE_FILE = args.cache_file
+WORKERS = args.workers
+MAX_RATE = args.max_rate
+VERBOSE = args.verbose
+SKIP_COMPLETE = args.skip_complete
+MERGE_NEAR_DUPLICATES = args.merge_near_duplicates
 
 REVERSED_KEYS = {"author", "booktitle", "doi", "title", "year", 'ID', 'ENTRYTYPE'}
+KEEP = tuple(REVERSED_KEYS - {'ID'})  # the ID always comes from the original entry
+IGNORED_KEYS = frozenset({'ID', 'ENTRYTYPE'})  # not compared between old and new entries
+COMPARED_KEYS = tuple(sorted(key for key in KEEP if key not in IGNORED_KEYS))
+# Fixed positional layout of the compared fields, so comparisons are tuple operations
+Fields = namedtuple('Fields', COMPARED_KEYS)
 
 logging.basicConfig(filename=LOG_FILE, level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+# --- HTTP SESSION ---
+# A single pooled session keeps the TCP/TLS connection to dblp.org alive across
+# queries; urllib3's Retry handles 429/5xx backoff (honouring Retry-After).
+REQUEST_TIMEOUT = (5, 15)  # (connect, read) seconds
+REQUEST_HEADERS = {"User-Agent": "GPTCiteFix/1.0 (+https://github.com/SeekingDream/GPTCiteFix)"}
+
+RETRY = Retry(
+    total=5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET"],
+    backoff_factor=1.0,
+    backoff_jitter=0.5,  # spread out retries from concurrent workers
+    respect_retry_after_header=True,
+)
+
+# Every request goes to dblp.org, so a single host pool of up to WORKERS kept-alive
+# connections suffices; when all are busy, requests wait for one instead of
+# opening overflow connections. Connections (re)opened after the server drops
+# them or on retries still resolve dblp.org again.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=WORKERS, pool_block=True,
+                                      max_retries=RETRY))
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all worker threads: on average `rate` acquisitions per
+    second, with bursts of at most `burst`. Callers reserve a token under the lock
+    and sleep off any deficit outside it, so waiting threads do not block others.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+# DBLP asks for less than about one request per second
+LIMITER = RateLimiter(MAX_RATE)
+
+
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def json_dumps(obj):
+    return orjson.dumps(obj) if orjson else json.dumps(obj)
+
+
+def dblp_get(url):
+    LIMITER.acquire()
+    return SESSION.get(url, timeout=REQUEST_TIMEOUT, headers=REQUEST_HEADERS)
+
 
 def read_bib_file(bib_file):
     with open(bib_file, encoding="utf-8") as f:
         bib_database = bibtexparser.load(f)
-    return [dict(entry) for entry in bib_database.entries]
+    # Entries are already plain dicts and are never mutated, so no copy is needed
+    return bib_database.entries
+
+
+# --- PERSISTENT CACHE ---
+CACHE_TTL = 30 * 24 * 3600  # seconds before a cached lookup is re-queried
+CACHE_COMMIT_EVERY = 50
+
+
+def open_cache(path):
+    cache = sqlite3.connect(path)
+    cache.execute("CREATE TABLE IF NOT EXISTS q(k TEXT PRIMARY KEY, v BLOB, ts INTEGER)")
+    cache.execute("DELETE FROM q WHERE ts < ?", (int(time.time()) - CACHE_TTL,))
+    cache.commit()
+    return cache
 
 
-# --- UPDATED QUERY FUNCTION WITH BACKOFF ---
-def query_dblp(title, max_retries=5):
+WHITESPACE = re.compile(r"\s+")
+STRIP_BRACES = str.maketrans("", "", "{}")
+
+
+def normalize_title(title):
+    # Used for grouping, cache keys and matching DBLP hits, so case and
+    # brace protection are ignored and line breaks collapse to single spaces
+    return WHITESPACE.sub(" ", title.translate(STRIP_BRACES)).strip().casefold()
+
+
+def normalize_value(value):
+    # Field comparison keeps case and inner braces, which are meaningful in BibTeX
+    return WHITESPACE.sub(" ", str(value)).strip("{} ")
+
+
+def cache_key(title):
+    return hashlib.sha1(normalize_title(title).encode()).hexdigest()
+
+
+def cache_get(cache, title):
+    row = cache.execute("SELECT v FROM q WHERE k=?", (cache_key(title),)).fetchone()
+    return json_loads(row[0]) if row else None
+
+
+def cache_put(cache, title, entry):
+    cache.execute("INSERT OR REPLACE INTO q VALUES (?, ?, ?)",
+                  (cache_key(title), json_dumps(entry), int(time.time())))
+
+
+# --- QUERY FUNCTIONS ---
+DBLP_SEARCH_URL = "https://dblp.org/search/publ/api"
+
+
+def search_dblp(title):
     """
-    Query DBLP for a paper title with exponential backoff for 429 errors.
+    Search DBLP for a single paper title and return the info of the top hit.
     """
-    search_url = f"https://dblp.org/search/publ/api?q={quote(title)}&format=json"
+    search_url = f"{DBLP_SEARCH_URL}?q={quote(title)}&format=json"
 
-    for attempt in range(max_retries):
-        try:
-            # Mandatory polite delay (DBLP prefers < 1 request per second)
-            time.sleep(1.0)
+    try:
+        resp = dblp_get(search_url)
+        resp.raise_for_status()
+        hits = json_loads(resp.content)['result']['hits'].get('hit')
+        if hits:
+            return hits[0]['info']
 
-            resp = requests.get(search_url)
+    except Exception as e:
+        logging.error(f"Error querying DBLP for {title}: {e}")
 
-            if resp.status_code == 429:
-                wait_time = (2 ** attempt) + 1
-                logging.warning(
-                    f"Rate limited (429). Retrying in {wait_time}s... (Attempt {attempt + 1}/{max_retries})")
-                time.sleep(wait_time)
-                continue
+    return None
 
-            resp.raise_for_status()
-            data = resp.json()
-            hits = data['result']['hits'].get('hit')
 
-            if not hits:
-                return None
+def fetch_dblp_bib(dblp_key):
+    """
+    Fetch the BibTeX record for a DBLP key.
+    """
+    try:
+        bib_resp = dblp_get(f"https://dblp.org/rec/{dblp_key}.bib")
+        if bib_resp.status_code == 200:
+            parsed_bib = bibtexparser.loads(bib_resp.text)
+            if parsed_bib.entries:
+                return dict(parsed_bib.entries[0])
 
-            dblp_key = hits[0]['info']['key']
-            bib_url = f"https://dblp.org/rec/{dblp_key}.bib"
+    except Exception as e:
+        logging.error(f"Error fetching DBLP record {dblp_key}: {e}")
 
-            # Fetch the BibTeX with the same retry logic implicit in the next loop if needed,
-            # but usually, if the search works, the direct link works.
-            bib_resp = requests.get(bib_url)
-            if bib_resp.status_code == 200:
-                parsed_bib = bibtexparser.loads(bib_resp.text)
-                if parsed_bib.entries:
-                    return dict(parsed_bib.entries[0])
+    return None
 
-            return None
 
-        except Exception as e:
-            logging.error(f"Error querying DBLP for {title}: {e}")
-            # If it's a connection error, we might want to retry
-            time.sleep(2)
+# Search hits whose BibTeX record has no kept field beyond what the hit carries.
+# Proceedings are excluded: their short DBLP venue is not the .bib booktitle.
+ARTICLE_TYPES = {"Journal Articles"}
+HOMONYM_SUFFIX = re.compile(r"\s+\d{4}$")  # e.g. "Wei Wang 0001"
+MIDWORD_CAPITAL = re.compile(r"\w[A-Z]")  # words DBLP protects with braces in .bib titles
+LATEX_SPECIAL = re.compile(r"[&%$#_{}~^\\]")  # characters DBLP escapes in .bib fields
 
-    return None
+
+def entry_from_info(info):
+    """
+    Build the kept fields of a DBLP record from its search hit. Returns None when
+    the .bib record is still needed: a booktitle, a missing field, or a title or
+    author list with non-ASCII text, LaTeX special characters or mid-word
+    capitals, which DBLP escapes or brace-protects in the .bib.
+    """
+    is_corr = info.get("type") == "Informal and Other Publications" and info.get("venue") == "CoRR"
+    if info.get("type") not in ARTICLE_TYPES and not is_corr:
+        return None
+
+    authors = info.get("authors", {}).get("author")
+    title = info.get("title", "")
+    year = info.get("year")
+    if not (authors and title and year):
+        return None
+
+    if isinstance(authors, dict):  # a single author is not wrapped in a list
+        authors = [authors]
+    author = " and ".join(HOMONYM_SUFFIX.sub("", a["text"]) for a in authors)
+    title = title[:-1] if title.endswith(".") else title
+    text = author + title
+    if not text.isascii() or LATEX_SPECIAL.search(text) or MIDWORD_CAPITAL.search(title):
+        return None
+
+    entry = {"ENTRYTYPE": "article", "author": author, "title": title, "year": year}
+    if info.get("doi"):
+        entry["doi"] = info["doi"]
+    return entry
+
+
+def lookup_record(info):
+    """
+    The DBLP record for a search hit, fetching the .bib only when the hit is not enough.
+    """
+    return entry_from_info(info) or fetch_dblp_bib(info["key"])
+
+
+# --- NEAR-DUPLICATE TITLES ---
+NEAR_DUP_THRESHOLD = 0.9  # minimum Jaccard similarity of title 3-grams to share a lookup
+# MinHash LSH with 8 bands of 4 rows: a pair at Jaccard 0.9 becomes a candidate with
+# probability 1 - (1 - 0.9 ** 4) ** 8 > 0.999; candidates are then checked exactly.
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4
+MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(0)  # fixed seed so clustering is reproducible across runs
+MINHASH_PERMUTATIONS = [(_rng.randrange(1, MERSENNE_PRIME), _rng.randrange(MERSENNE_PRIME))
+                        for _ in range(MINHASH_BANDS * MINHASH_ROWS)]
+del _rng
+
+
+def title_shingles(key):
+    return {key[i:i + 3] for i in range(max(1, len(key) - 2))}
+
+
+def minhash_bands(shingles):
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+              for shingle in shingles]
+    signature = [min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in MINHASH_PERMUTATIONS]
+    return [(band, tuple(signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]))
+            for band in range(MINHASH_BANDS)]
+
+
+def cluster_titles(keys):
+    """
+    Map each normalized title to the representative of its near-duplicate cluster:
+    the first earlier title whose 3-gram Jaccard similarity is at least
+    NEAR_DUP_THRESHOLD, or the title itself.
+    """
+    buckets = {}  # (band, band signature) -> representative titles
+    rep_shingles = {}
+    rep_of = {}
+    for key in keys:
+        shingles = title_shingles(key)
+        bands = minhash_bands(shingles)
+        rep_of[key] = next(
+            (rep for band in bands for rep in buckets.get(band, ())
+             if len(shingles & rep_shingles[rep]) / len(shingles | rep_shingles[rep]) >= NEAR_DUP_THRESHOLD),
+            None)
+        if rep_of[key] is None:
+            rep_of[key] = key
+            rep_shingles[key] = shingles
+            for band in bands:
+                buckets.setdefault(band, []).append(key)
+    return rep_of
 
 
 # --- STEP 3: COMPARE AND LOG DIFFERENCES ---
+def normalize_fields(entry):
+    """
+    The compared fields of an entry, normalized with normalize_value, as a Fields
+    tuple. Absent fields are None on both the original and the DBLP side.
+    """
+    return Fields._make(normalize_value(entry[key]) if key in entry else None
+                        for key in COMPARED_KEYS)
+
+
+def field_differs(old_val, new_val):
+    # Only fields present in the DBLP record count; an absent original field is ""
+    return new_val is not None and (old_val or "") != new_val
+
+
 def compare_entries(old_entry, new_entry):
     differences = {}
-    ignored_keys = ['ID', 'ENTRYTYPE']
-    for key, value in new_entry.items():
-        if key not in ignored_keys:
-            old_val = str(old_entry.get(key, "")).strip("{} ")
-            new_val = str(value).strip("{} ")
-            if old_val != new_val:
-                differences[key] = {"old": old_entry.get(key), "new": value}
+    old_fields = normalize_fields(old_entry)
+    new_fields = normalize_fields(new_entry)
+    for key, old_val, new_val in zip(COMPARED_KEYS, old_fields, new_fields):
+        if field_differs(old_val, new_val):
+            differences[key] = {"old": old_entry.get(key), "new": new_entry[key]}
     return differences
 
 
+def has_changes(old_fields, new_fields):
+    """
+    Whether any field present in the DBLP record differs from the original entry.
+    Identical layouts, including the same absent fields, short-circuit on one
+    tuple comparison.
+    """
+    if old_fields == new_fields:
+        return False
+    return any(field_differs(old_val, new_val) for old_val, new_val in zip(old_fields, new_fields))
+
+
+def is_complete(entry):
+    """
+    Whether an entry already looks well-formed enough to keep without a DBLP lookup.
+    """
+    return bool(entry.get('doi') and entry.get('year') and entry.get('author')
+                and len(entry.get('title', '')) > 10)
+
+
+def process_entry(entry, resolved, skip_complete=False):
+    """
+    Classify one original entry against the resolved DBLP records and pick the
+    entry to write. Returns (status, entry_id, out_entry), where status is one
+    of "changed", "unchanged", "no_title" or "not_found".
+    """
+    entry_id = entry.get('ID')
+    title = entry.get("title")
+    if not title:
+        return "no_title", entry_id, entry
+    if skip_complete and is_complete(entry):
+        return "unchanged", entry_id, entry
+
+    record = resolved.get(normalize_title(title))
+    if record is None:
+        return "not_found", entry_id, entry
+
+    filtered_new, new_fields = record
+    if has_changes(normalize_fields(entry), new_fields):
+        return "changed", entry_id, dict(filtered_new, ID=entry_id)
+    return "unchanged", entry_id, entry
+
+
+def same_title(title, key):
+    """
+    Whether a title normalizes to the normalized title `key`, ignoring the
+    trailing period DBLP puts on titles.
+    """
+    return normalize_title(title).rstrip(".") == key.rstrip(".")
+
+
+def lookup_titles(cache, titles):
+    """
+    Look up the DBLP record for each title, from the cache where possible. Returns
+    a dict from normalized title to the record, or None if none was found.
+    """
+    results = {normalize_title(title): cache_get(cache, title) for title in titles}
+    titles = [title for title in titles if results[normalize_title(title)] is None]
+
+    # DBLP lookups are network-bound, so run them concurrently (bounded by WORKERS)
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        # Resolve titles to DBLP hits. The record lookup for a title is queued as soon
+        # as its search returns, so workers move on to fetching instead of idling
+        # until the slowest search has finished.
+        searches = {pool.submit(search_dblp, title): title for title in titles}
+        fetches = {}
+        for search in tqdm(as_completed(searches), total=len(searches), desc="Searching"):
+            info = search.result()
+            if info:
+                fetches[pool.submit(lookup_record, info)] = searches[search]
+
+        for i, fetch in enumerate(tqdm(as_completed(fetches), total=len(fetches), desc="Fetching"), 1):
+            title = fetches[fetch]
+            new_entry = fetch.result()
+            results[normalize_title(title)] = new_entry
+            # Only successful lookups are cached; misses may be transient errors
+            if new_entry:
+                cache_put(cache, title, new_entry)
+            if i % CACHE_COMMIT_EVERY == 0:
+                cache.commit()
+    cache.commit()
+    return results
+
+
 def main():
     old_entries = read_bib_file(BIB_FILE)
-    updated_entries = []
 
-    changed_ids, unchanged_ids, no_title_ids, not_found_ids = [], [], [], []
+    ids = {"changed": [], "unchanged": [], "no_title": [], "not_found": []}
 
     print(f"Processing {len(old_entries)} entries. Please wait...")
-    for entry in tqdm(old_entries):
+    # Entries sharing a title (e.g. duplicate citekeys from merged bibs) need one lookup
+    groups = defaultdict(list)
+    for entry in old_entries:
         title = entry.get("title")
-        entry_id = entry.get('ID')
-
-        if not title:
-            no_title_ids.append(entry_id)
-            updated_entries.append(entry)
-            continue
-
-        new_entry = query_dblp(title)
+        if title and not (SKIP_COMPLETE and is_complete(entry)):
+            groups[normalize_title(title)].append(entry)
+
+    # Optionally, near-duplicate titles (punctuation or spelling variants) share the
+    # lookup of their cluster's representative
+    rep_of = cluster_titles(groups) if MERGE_NEAR_DUPLICATES else {key: key for key in groups}
+
+    cache = open_cache(CACHE_FILE)
+    results = lookup_titles(cache, [groups[rep][0]["title"] for rep in dict.fromkeys(rep_of.values())])
+
+    # A representative's record is only shared with cluster members whose own title
+    # matches the DBLP title; the others (e.g. "Part I" vs "Part II") are looked up
+    # on their own
+    unverified = [key for key, rep in rep_of.items()
+                  if key != rep and not (results[rep] and same_title(results[rep].get("title", ""), key))]
+    if unverified:
+        results.update(lookup_titles(cache, [groups[key][0]["title"] for key in unverified]))
+        rep_of.update((key, key) for key in unverified)
+    cache.close()
+
+    # Filter and normalize each DBLP record once per looked-up title, then share it
+    # with the titles of its cluster
+    for rep, new_entry in results.items():
         if new_entry:
-            # Filter keys based on your REVERSED_KEYS list
-            filtered_new = {k: new_entry[k] for k in REVERSED_KEYS if k in new_entry}
-
-            diff = compare_entries(entry, filtered_new)
-            filtered_new['ID'] = entry_id
-
-            if diff:
-                changed_ids.append(entry_id)
-                updated_entries.append(filtered_new)
-            else:
-                unchanged_ids.append(entry_id)
-                updated_entries.append(entry)
-        else:
-            not_found_ids.append(entry_id)
-            updated_entries.append(entry)
-
-    # --- LOG SUMMARY ---
-    # (Existing logging and file writing code remains the same)
-    bib_database = bibtexparser.bibdatabase.BibDatabase()
-    bib_database.entries = updated_entries
+            filtered_new = {k: new_entry[k] for k in KEEP if k in new_entry}
+            results[rep] = filtered_new, normalize_fields(filtered_new)
+    resolved = {key: results[rep] for key, rep in rep_of.items() if results[rep]}
+    del results
+
+    # --- WRITE OUTPUT ---
+    # Entries are serialized one at a time, in the order bibtexparser.dump would use,
+    # instead of collecting every updated entry and rendering the whole file at once.
+    writer = BibTexWriter()
+    single = BibDatabase()
+    sorted_entries = sorted(old_entries, key=lambda e: BibDatabase.entry_sort_key(e, writer.order_entries_by))
     with open(OUTPUT_BIB_FILE, "w", encoding="utf-8") as f:
-        bibtexparser.dump(bib_database, f)
+        for i, entry in enumerate(sorted_entries):
+            status, entry_id, out_entry = process_entry(entry, resolved, SKIP_COMPLETE)
+            ids[status].append(entry_id)
+            if VERBOSE and status == "changed":
+                logging.info(f"{entry_id} changed: {compare_entries(entry, out_entry)}")
 
-    print(f"\nDone! Updated: {len(changed_ids)}, Unchanged: {len(unchanged_ids)}, Not Found: {len(not_found_ids)}")
+            single.entries = [out_entry]
+            if i:
+                f.write(writer.entry_separator)
+            f.write(writer.write(single))
+
+    # --- LOG SUMMARY ---
+    # A single logging call for the whole summary, rather than one per entry ID
+    summary = ["Summary:"]
+    for label, status in (("Updated", "changed"), ("Unchanged", "unchanged"),
+                          ("No title", "no_title"), ("Not found", "not_found")):
+        summary.append(f"{label} ({len(ids[status])}):")
+        summary.extend(f"  {entry_id}" for entry_id in ids[status])
+    logging.info("\n".join(summary))
+
+    print(f"\nDone! Updated: {len(ids['changed'])}, Unchanged: {len(ids['unchanged'])}, "
+          f"Not Found: {len(ids['not_found'])}")
 
 
 if __name__ == "__main__":